@@ -11,32 +11,57 @@ Returns a list of submitters for a given status of SMR address.
 get_smr_address_from_quest_completers()
 Retrieves the SMR addresses of users who completed a quest and won an NFT airdrop.
 
-send_to_address(addresses: list)
+send_to_address(addresses: Iterable[str])
 Sends NFTs to the addresses, if addresses are present.
 
 
 Note: The module imports the following variables and functions from the tools module:
-get_zealy_api_data, return_valid_shimmer_addresses, logger, basic_checks, create_shimmer_profile,
-get_available_nfts, send_nfts, check_if_sent, unique_addresses, subdomain, x_api_key,
+iter_zealy_api_data, iter_valid_shimmer_addresses, logger, basic_checks, create_shimmer_profile,
+get_available_nfts, send_nfts, iter_new_addresses, subdomain, x_api_key,
 nft_drop_quest_id, smr_address_quest_id, validate_zealy_api_data, validate_shimmer_address,
-shimmer_address_hrp, collection_nft_id, mint_nfts, delta_days.
+shimmer_address_hrp, collection_nft_id, mint_nfts, invalidate_zealy_api_data, delta_days.
 """
 import time
+from collections import deque
+from itertools import islice
 from datetime import datetime, timedelta
-import multiprocessing
+import os
 import re
-from tools import (get_zealy_api_data, return_valid_shimmer_addresses, logger,
+import threading
+from tools import (iter_zealy_api_data, iter_valid_shimmer_addresses, logger,
                    basic_checks, create_shimmer_profile, get_available_nfts,
-                   send_nfts, check_if_sent, unique_addresses, subdomain, x_api_key,
+                   send_nfts, iter_new_addresses, subdomain, x_api_key,
                    nft_drop_quest_id, smr_address_quest_id, validate_zealy_api_data,
                    validate_shimmer_address, shimmer_address_hrp, collection_nft_id,
-                   mint_nfts)
+                   mint_nfts, invalidate_zealy_api_data)
+
+# Matches the address in a submission
+SMR_ADDR_RE = re.compile(rf"{re.escape(shimmer_address_hrp)}\w+")
+
+# A Stardust block holds at most 32 KiB. Each NFT output carries the IRC27 metadata,
+# issuer and unlock conditions, and spends its own NFT input, about 500 bytes in all.
+# Keep 4 KiB for the inputs paying the storage deposit, the remainder and the signatures.
+MAX_BLOCK_BYTES = 32 * 1024
+ESTIMATED_BYTES_PER_NFT = 500
+MAX_NFTS_PER_TRANSACTION = (MAX_BLOCK_BYTES - 4 * 1024) // ESTIMATED_BYTES_PER_NFT
+CHUNK_SIZE = max(1, min(int(os.getenv("NFT_CHUNK_SIZE", "50")), MAX_NFTS_PER_TRANSACTION))
+
+# Poll again after BASE_SLEEP seconds, doubling after each empty poll up to MAX_SLEEP.
+# Keep BASE_SLEEP above tools.zealy_cache_ttl so polls never read stale cached pages
+BASE_SLEEP = 30
+MAX_SLEEP = 5 * 60
 
 ##########################
 # Start
 ##########################
 
 
+def backoff_sleep(streak_empty):
+    """Returns the seconds to wait after streak_empty polls in a row found nothing."""
+    return min(MAX_SLEEP, BASE_SLEEP * 2 ** streak_empty)
+
+
+
 def get_nft_winners():
     """
     This function retrieves the list of the winners of the NFT airdrop by
@@ -47,24 +72,23 @@ def get_nft_winners():
     None
 
     Returns:
-    list: A list of user IDs who successfully completed the NFT airdrop quest.
+    frozenset: A set of user IDs who successfully completed the NFT airdrop quest.
 
     Example:
     >>> get_nft_winners()
-    [123, 456, 789]
+    frozenset({123, 456, 789})
     """
     logger.info("Get the list of the NFT winners")
     status = "success"
-    nft_airdrop_quest_completers = get_zealy_api_data(
-        subdomain,
-        x_api_key,
-        nft_drop_quest_id,
-        status
-        )
-    nft_airdrop_user_ids = []
-    for item in nft_airdrop_quest_completers['data']:
-        nft_airdrop_user_id = item['user']['id']
-        nft_airdrop_user_ids.append(nft_airdrop_user_id)
+    nft_airdrop_user_ids = frozenset(
+        item['user']['id']
+        for item in iter_zealy_api_data(
+            subdomain,
+            x_api_key,
+            nft_drop_quest_id,
+            status
+            )
+    )
     logger.debug("nft_airdrop_user_ids %s", nft_airdrop_user_ids)
     return nft_airdrop_user_ids
 
@@ -82,18 +106,18 @@ def get_smr_address_submitters(status):
     get_smr_address_submitters('success')  # Returns ['43289723890', '3290480239']
     """
     logger.info("Query Zealy for submitted addresses")
-    smr_address_quest_completers = get_zealy_api_data(
+    smr_address_quest_completers = iter_zealy_api_data(
         subdomain,
         x_api_key,
         smr_address_quest_id,
         status
         )
     smr_address_submitters = []
-    for item in smr_address_quest_completers['data']:
+    for item in smr_address_quest_completers:
         smr_address_user_id = item['user']['id']
         smr_address = item['submission']['value']
         # Remove any excessive characters/text from possible input
-        match = re.search(r"smr1\w+", smr_address)
+        match = SMR_ADDR_RE.search(smr_address)
         if match:
             smr_address = match.group()
         else:
@@ -124,40 +148,53 @@ def get_smr_address_from_quest_completers():
     smr_address_quest_completers = get_smr_address_submitters(status="success")
     logger.debug("Address Submitters %s", smr_address_quest_completers)
 
-    # Iterate over each element in smr_address_submitters
-    smr_addresses = []
-    for submitter in smr_address_quest_completers:
-        user_id, smr_address = submitter
-        # Check if the discord ID is in nft_airdrop_user_ids
-        if user_id in nft_airdrop_quest_completers:
-            # If it is, append the SMR address to the smr_addresses list
-            smr_addresses.append(smr_address)
-    logger.debug("appended addresses %s", smr_addresses)
-    smr_addresses = unique_addresses(smr_addresses)
+    # Keep the addresses of the NFT winners, deduplicated in submission order
+    smr_addresses = list(dict.fromkeys(
+        smr_address
+        for user_id, smr_address in smr_address_quest_completers
+        if user_id in nft_airdrop_quest_completers
+    ))
     logger.debug("unique addresses %s", smr_addresses)
     return smr_addresses
 
+def send_outputs(outputs):
+    """Send the outputs, halving the chunk while the transaction is too large.
+
+    Returns the amount of NFTs that were sent and written to the CSV file.
+    """
+    amount_sent = send_nfts(outputs)
+    if amount_sent is not False:
+        return amount_sent
+    if len(outputs) <= 1:
+        return 0
+    half = len(outputs) // 2
+    logger.warning("Transaction too large, retrying with %s outputs", half)
+    return send_outputs(outputs[:half]) + send_outputs(outputs[half:])
+
+def get_nft_ids():
+    """Returns a deque of the available NFT IDs, without the collection NFT."""
+    return deque(nft_id for nft_id in get_available_nfts() if nft_id != collection_nft_id)
+
 def send_to_address(addresses):
     """Send NFTs to the provided addresses, if any.
 
     Args:
-        addresses (list): A list of string values representing the addresses of recipients.
+        addresses (iterable): String values representing the addresses of recipients,
+            consumed CHUNK_SIZE addresses at a time.
 
     Returns:
-        None
+        int: The amount of addresses NFTs were sent to and written to the CSV file.
 
     Logs:
         Logs the following information at the info level:
             - 'Sending NFTs to the addresses, if addresses are present'
             - 'No addresses provided' if the addresses argument is empty
-            - 'Amount of addresses: %s' with the length of addresses as the parameter
+            - 'Amount of addresses: %s' with the amount of addresses as the parameter
     """
     logger.info("Sending NFTs to the addresses, if addresses are present")
-    if not addresses:
-        logger.info("No addresses provided")
-        return
-
-    logger.info("Amount of addresses: %s",len(addresses))
+    addresses = iter(addresses)
+    amount_of_addresses = 0
+    amount_sent = 0
     invalid_rows = []
 
     # Generate unixtimestamp for the expiry condition
@@ -172,95 +209,92 @@ def send_to_address(addresses):
     expiration_unixtime = int(time.mktime(one_year_from_now.timetuple()))
     timelock_unixtime = int(time.mktime(six_months_from_now.timetuple()))
 
+    nft_ids = None
 
-    # Define the outputs array
-    outputs = []
-
-    nft_ids = get_available_nfts() # get all available NFT IDs
-    logger.debug("Available NFTs: %s", len(nft_ids))
+    # Take the addresses in chunks of CHUNK_SIZE addresses
+    while chunk := list(islice(addresses, CHUNK_SIZE)):
+        amount_of_addresses += len(chunk)
+        if nft_ids is None:
+            nft_ids = get_nft_ids() # get all available NFT IDs
+            logger.debug("Available NFTs: %s", len(nft_ids))
 
-    # remove 1 to account for the available collection NFT id
-    while len(addresses) > (len(nft_ids) - 1):
-        num_missing_nfts = len(addresses) - (len(nft_ids) - 1)
-        logger.warning(
-            "Not enough available NFTs for all addresses. Minting %s more NFTs",
-            num_missing_nfts
-            )
-        logger.debug("Required NFTS: %s", num_missing_nfts)
-        mint_nfts(num_missing_nfts)
-        nft_ids = get_available_nfts() # update the available NFT IDs
-        logger.info("Available NFTs: %s", len(nft_ids))
-
-    # Split addresses into chunks of 10 addresses
-    chunks = [addresses[i:i+10] for i in range(0, len(addresses), 10)]
+        while len(chunk) > len(nft_ids):
+            num_missing_nfts = len(chunk) - len(nft_ids)
+            logger.warning(
+                "Not enough available NFTs for all addresses. Minting %s more NFTs",
+                num_missing_nfts
+                )
+            logger.debug("Required NFTS: %s", num_missing_nfts)
+            mint_nfts(num_missing_nfts)
+            nft_ids = get_nft_ids() # update the available NFT IDs
+            logger.info("Available NFTs: %s", len(nft_ids))
 
-    for chunk in chunks:
+        # Define the outputs array
+        outputs = []
         for address in chunk:
             try:
-                while True:
-                    nft_id = nft_ids.pop(0)  # get and remove the first available NFT ID
-                    if nft_id == collection_nft_id:
-                        logger.warning("Skipping NFT ID %s for address %s",
-                                        collection_nft_id,
-                                        address
-                                       )
-                        continue
-                    logger.debug("Address: %s", address)
-                    logger.debug("NFT ID: %s", nft_id)
-                    logger.debug("Expiration time: %s", expiration_unixtime)
-                    logger.debug("Timelock time: %s", timelock_unixtime)
-                    outputs.append(
-                        {
-                        "amount": "0",
-                        "recipientAddress": address,
-                        "unlocks":
-                            {
-                              "expirationUnixTime": expiration_unixtime,
-                              "timelockUnixTime": timelock_unixtime,
-                            },
-                        "storageDeposit":
-                            {
-                            "returnStrategy": "Gift",
-                            },
-                        "assets":
-                        {
-                        "nftId": nft_id,
-                        },
-                        }
-                    )
-                    break  # Exit the loop once a valid NFT ID is found
+                nft_id = nft_ids.popleft()  # get and remove the first available NFT ID
             except IndexError:
                 logger.warning("No more available NFTs for address %s", address)
                 invalid_rows.append(address)
+                continue
+            logger.debug("Address: %s", address)
+            logger.debug("NFT ID: %s", nft_id)
+            logger.debug("Expiration time: %s", expiration_unixtime)
+            logger.debug("Timelock time: %s", timelock_unixtime)
+            outputs.append(
+                {
+                "amount": "0",
+                "recipientAddress": address,
+                "unlocks":
+                    {
+                      "expirationUnixTime": expiration_unixtime,
+                      "timelockUnixTime": timelock_unixtime,
+                    },
+                "storageDeposit":
+                    {
+                    "returnStrategy": "Gift",
+                    },
+                "assets":
+                {
+                "nftId": nft_id,
+                },
+                }
+            )
 
         # Call send_smr_tokens with the outputs array
         logger.debug("Prepared Outputs Chunk: %s", outputs)
-        send_nfts(outputs)
-        # Reset the outputs array for the next chunk
-        outputs = []
+        amount_sent += send_outputs(outputs)
 
-def get_smr_address_from_quest_and_verify():
+    if not amount_of_addresses:
+        logger.info("No addresses provided")
+    else:
+        logger.info("Amount of addresses: %s", amount_of_addresses)
+        logger.info("NFTs sent: %s", amount_sent)
+    return amount_sent
+
+def get_smr_address_from_quest_and_verify(new_addresses_event=None):
     """
     Get the Shimmer (SMR) address from address submission quest and verify.
 
     This function gets the SMR address from the address submission quest and
     verifies it. It repeatedly polls the Zealy API for new submissions in
     the quest, validates the submitted addresses and marks them as valid or
-    invalid accordingly. The function waits for 2 minutes before polling again
-    if there are no new submissions in the quest.
-    If a valid SMR address is found, it is returned.
+    invalid accordingly. The function waits 30 seconds before polling again,
+    doubling the wait up to 5 minutes while there are no new submissions in
+    the quest.
 
-    Returns:
-    -------
-    str
-        The valid SMR address if it is found in the quest, otherwise None.
+    Args:
+    - new_addresses_event (Event, optional): Set whenever addresses are marked
+      as valid, to wake up the NFT dropper.
     """
     logger.info(
         "Get %s address from address submission quest",
         shimmer_address_hrp
         )
+    streak_empty = 0
     while True:
-        smr_address_quest_completers = get_zealy_api_data(
+        smr_address_quest_completers = iter_zealy_api_data(
             subdomain,
             x_api_key,
             smr_address_quest_id,
@@ -269,11 +303,9 @@ def get_smr_address_from_quest_and_verify():
         smr_address_submitters = []
         valid_addresses_quest_ids = []
         invalid_addresses_quest_ids = []
-        if not smr_address_quest_completers:
-            return
 
         # Iterate over submissions and validate shimmer addresses
-        for item in smr_address_quest_completers['data']:
+        for item in smr_address_quest_completers:
             smr_address_submission_id = item['id']
             smr_address = item['submission']['value']
             smr_address_user_object = (smr_address_submission_id, smr_address)
@@ -303,6 +335,11 @@ def get_smr_address_from_quest_and_verify():
                 comment
                 )
             logger.debug(valid_data)
+            # The reviewed submissions moved from pending to success
+            invalidate_zealy_api_data(smr_address_quest_id, "pending")
+            invalidate_zealy_api_data(smr_address_quest_id, status)
+            if new_addresses_event is not None:
+                new_addresses_event.set()
 
         if invalid_addresses_quest_ids:
             comment = f"Thank you, but the submitted address is not a valid Shimmer address. A valid address starts with {shimmer_address_hrp}. Download the official Shimmer Firefly wallet from https://firefly.iota.org and submit a new address."
@@ -315,17 +352,29 @@ def get_smr_address_from_quest_and_verify():
                 comment
                 )
             logger.debug(invalid_data)
+            # The reviewed submissions moved from pending to fail
+            invalidate_zealy_api_data(smr_address_quest_id, "pending")
+            invalidate_zealy_api_data(smr_address_quest_id, status)
 
-        time.sleep(2 * 60)  # Pause the script for 15 minutes
+        if smr_address_submitters:
+            streak_empty = 0
+        else:
+            streak_empty = min(streak_empty + 1, 8)
+        time.sleep(backoff_sleep(streak_empty))
 
-def run_nft_dropper():
+def run_nft_dropper(new_addresses_event=None):
     """
     Runs the NFT dropper process.
 
     It checks if the basic information has been filled out in the .env file and 
     creates a Shimmer profile. Then, it checks if new addresses have been submitted 
     and verifies the Shimmer addresses. Finally, it sends NFTs to valid addresses.
-    The script sleeps for 2 minutes between each iteration.
+    The script sleeps 30 seconds between iterations, doubling up to 5 minutes
+    while no new addresses are found, and wakes up early when new_addresses_event is set.
+
+    Args:
+        new_addresses_event (Event, optional): Set by the address verifier when
+            new addresses were marked as valid.
 
     Returns:
         None
@@ -338,20 +387,35 @@ def run_nft_dropper():
         "Make sure to fill out the information in the .env file. Rename .env.exmple to .env first."
         )
     create_shimmer_profile()
+    streak_empty = 0
     while True:
-        smr_address = check_if_sent(get_smr_address_from_quest_completers())
-        logger.debug(("These are new addresses %s", smr_address))
+        # Stream the new, valid addresses straight into the sender
+        smr_address = iter_new_addresses(get_smr_address_from_quest_completers())
+        smr_address = iter_valid_shimmer_addresses(smr_address)
+        amount_sent = send_to_address(smr_address)
 
-        smr_address = return_valid_shimmer_addresses(smr_address)
-        send_to_address(smr_address)
-        time.sleep(2 * 60)  # Pause the script for 15 minutes
+        if amount_sent:
+            streak_empty = 0
+        else:
+            streak_empty = min(streak_empty + 1, 8)
+        if new_addresses_event is None:
+            time.sleep(backoff_sleep(streak_empty))
+        elif new_addresses_event.wait(timeout=backoff_sleep(streak_empty)):
+            new_addresses_event.clear()
 
 if __name__ == "__main__":
-    logger.info("Starting processes")
-    # Create processing for the bot and the richlist generation
-    process_one = multiprocessing.Process(target=run_nft_dropper)
-    process_two = multiprocessing.Process(target=get_smr_address_from_quest_and_verify)
-
-    # Start the processs
-    process_one.start()
-    process_two.start()
+    logger.info("Starting threads")
+    # Both loops only wait on the network, so threads share one wallet and cache
+    new_addresses_event = threading.Event()
+    thread_one = threading.Thread(
+        target=run_nft_dropper, args=(new_addresses_event,), daemon=True
+        )
+    thread_two = threading.Thread(
+        target=get_smr_address_from_quest_and_verify, args=(new_addresses_event,), daemon=True
+        )
+
+    # Start the threads
+    thread_one.start()
+    thread_two.start()
+    thread_one.join()
+    thread_two.join()
@@ -7,12 +7,14 @@ database names, account details, node URL, API key, subdomain, and delta_days.
 
 It also defines a logger object that logs the events and errors generated by the module.
 
-The module defines several functions, including check_if_sent, which checks if
-the NFTs have already been sent to the specified addresses; send_nfts,
+The module defines several functions, including iter_new_addresses, which skips
+the addresses the NFTs have already been sent to; send_nfts,
 which sends NFTs to a single address; and write_to_csv, which writes
 the transaction details to a CSV file.
 """
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from iota_client import IotaClient
 from iota_wallet import IotaWallet, StrongholdSecretManager
 import logging
@@ -23,7 +25,11 @@ import environ
 import time
 import csv
 import json
+import orjson
 import random
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 env = environ.Env()
 environ.Env.read_env()
@@ -34,7 +40,8 @@ stronghold_db_name = os.getenv("STRONGHOLD_DB_NAME")
 wallet_db_name = os.getenv("WALLET_DB_NAME")
 shimmer_mnemonic = os.getenv("SHIMMER_MNEMONIC")
 shimmer_account_name = os.getenv("SHIMMER_ACCOUNT_NAME")
-shimmer_address_hrp = os.getenv("SHIMMER_ADDRESS_HRP")
+# Default to the mainnet hrp if none is set
+shimmer_address_hrp = os.getenv("SHIMMER_ADDRESS_HRP") or "smr1"
 collection_nft_address = os.getenv("COLLECTION_NFT_ADDRESS")
 collection_nft_id = os.getenv("COLLECTION_NFT_ID")
 node_url = os.getenv("NODE_URL")
@@ -76,89 +83,164 @@ coin_type = 4219
 secret_manager = StrongholdSecretManager(stronghold_db_name, stronghold_password)
 client = IotaClient(client_options)
 
-def check_if_sent(addresses):
+# Wallet and account shared by every wallet operation, opened on first use
+shimmer_wallet = None
+shimmer_account = None
+shimmer_wallet_lock = threading.Lock()
+
+def get_wallet():
+    """Returns the shared Shimmer wallet, opening it on first use."""
+    global shimmer_wallet
+    with shimmer_wallet_lock:
+        if shimmer_wallet is None:
+            shimmer_wallet = IotaWallet(wallet_db_name, client_options, coin_type, secret_manager)
+            shimmer_wallet.set_stronghold_password(stronghold_password)
+        return shimmer_wallet
+
+def get_account():
+    """Returns the shared Shimmer account, retrieving it on first use."""
+    global shimmer_account
+    wallet = get_wallet()
+    with shimmer_wallet_lock:
+        if shimmer_account is None:
+            shimmer_account = wallet.get_account(shimmer_account_name)
+            logger.info("Account retrieved")
+        return shimmer_account
+
+# Addresses already in the CSV file, re-read when the file's mtime changes
+sent_addresses_cache = None
+sent_addresses_mtime = None
+
+##########################
+# Zealy API session
+##########################
+# Reuse connections to the Zealy API and retry on rate limits and server errors
+zealy_retries = Retry(
+    total=5, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504]
+)
+zealy_session = requests.Session()
+zealy_session.mount(
+    "https://",
+    HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=zealy_retries),
+)
+
+# Cache claimed quest pages for a short while, keyed by (quest_id, status, page, limit).
+# The TTL stays below the shortest polling sleep in main.py (30 seconds), so every poll
+# revalidates its pages with an ETag instead of re-reading a possibly stale cache
+zealy_cache_ttl = 20
+zealy_cache_maxsize = 128
+zealy_cache = {}
+zealy_cache_lock = threading.Lock()
+
+def iter_new_addresses(addresses):
     """
-    Checks if the given addresses have already been sent to, based on a CSV file.
+    Yields the given addresses that have not been sent to yet, based on a CSV file.
     
     Args:
-        addresses (list[str]): A list of email addresses to check.
+        addresses (Iterable[str]): The Shimmer addresses to check.
     
-    Returns:
-        list[str]: A list of email addresses that have not yet been sent to.
+    Yields:
+        str: The Shimmer addresses that have not yet been sent to.
         
     Raises:
         FileNotFoundError: If the CSV file containing previously sent addresses
         cannot be found.
     """
-    with open(shimmer_address_sent_to_filename, encoding="UTF-8") as file:
-        csv_reader = csv.reader(file)
-        sent_addresses = {row[0]: True for row in csv_reader}
-
-    new_addresses = []
+    global sent_addresses_cache, sent_addresses_mtime
+    # Only re-read the CSV file when it changed since the last read
+    mtime = os.stat(shimmer_address_sent_to_filename).st_mtime_ns
+    if sent_addresses_cache is None or mtime != sent_addresses_mtime:
+        with open(shimmer_address_sent_to_filename, encoding="UTF-8") as file:
+            csv_reader = csv.reader(file)
+            sent_addresses_cache = {row[0] for row in csv_reader if row}
+        sent_addresses_mtime = mtime
+    sent_addresses = sent_addresses_cache
+
+    amount_new = amount_total = 0
     for address in addresses:
-        if address in sent_addresses:
-            logger.info("%s is already in the CSV", address)
-        else:
-            logger.info("%s  is a new address, sending", address)
-            new_addresses.append(address)
-
-    return new_addresses
-
+        amount_total += 1
+        if address not in sent_addresses:
+            amount_new += 1
+            yield address
+    logger.info("%s of %s addresses are new", amount_new, amount_total)
+
+
+@functools.lru_cache(maxsize=None)
+def get_network_id():
+    """Returns the network id of the node, fetched once."""
+    return str(client.get_network_id())
+
+# Messages of the client errors raised when a transaction has too many inputs or
+# outputs, or its payload does not fit in a block
+TRANSACTION_TOO_LARGE_ERRORS = (
+    "invalid input count",
+    "invalid output count",
+    "invalid payload length",
+    "invalid transaction payload length",
+    "invalid block length",
+    "consolidation required",
+)
+
+def is_transaction_too_large_error(error):
+    """Checks if an error was raised because a transaction was too large."""
+    message = str(error).lower()
+    return any(variant in message for variant in TRANSACTION_TOO_LARGE_ERRORS)
 
 def send_nfts(outputs):
-    """Sends SMR tokens to a single address."""
+    """Sends NFTs to the addresses in the outputs.
+
+    Returns False if the transaction was rejected for being too large,
+    so the caller can retry with smaller chunks, and otherwise the amount
+    of NFTs that were sent and written to the CSV file.
+    """
     logger.info("Received bulk outputs.")
     logger.debug("Received bulk outputs: %s", outputs)
     try:
-        # Sync account with the node
-        wallet = IotaWallet(wallet_db_name, client_options, coin_type, secret_manager)
-        account = wallet.get_account(shimmer_account_name)
-        logger.info("Account retrieved")
+        # The account was synced by get_available_nfts or the previous chunk
+        account = get_account()
         address = account.addresses()
         logger.debug("Address: %s", address[0]['address'])
         balance = account.get_balance()
         logger.debug("Balance: %s", balance)
-        account.sync()
-        logger.info("Account Synced")
 
         # Verify if there is enough balance
         # check_enough_balance(account_status)
 
-        # Set the Stronghold password
-        wallet.set_stronghold_password(stronghold_password)
-
         # Define the output transaction
         logger.debug("Outputs: %s", outputs)
 
+        amount_recorded = 0
         try:
-            # Build the output now
-            outputs_to_send = []
-            for output in outputs:
-                prepared_output = account.prepare_output(output)
-                outputs_to_send.append(prepared_output)
+            # Fetch the network id before any funds move, so it cannot fail afterwards
+            network_id = get_network_id()
+
+            # Build the outputs now, one at a time as the wallet binding may not be thread-safe
+            outputs_to_send = [account.prepare_output(output) for output in outputs]
 
             # Send the transaction with the defined outputs
             transaction = account.send_outputs(outputs_to_send)
             logger.info("Transaction sent")
             transaction_id = transaction['transactionId']
-            account.retry_transaction_until_included(transaction_id)
+            # Use the block that got included, which differs from the first one if reattached
+            included_block_id = account.retry_transaction_until_included(transaction_id)
+            # Sync so the next chunk can spend this transaction's remainder
             account.sync()
             logger.debug("Transaction %s", transaction)
-            transaction = account.get_transaction(transaction_id)
-            # Check if the transaction's networkId is the
-            # mainnet (14364762045254553490)
-            # testnet (1856588631910923207)
-            if transaction["networkId"] == "1856588631910923207":
+            # Check if the transaction's networkId is the one of the node
+            if str(transaction["networkId"]) == network_id:
                 # Get the blockId for this transaction
-                block_id = transaction["blockId"]
-                for item in outputs:
-                    address = item["recipientAddress"]
-                    nftId = item["assets"]["nftId"]
-                    write_to_csv(address, nftId, block_id)
-
-        except Exception:
+                block_id = included_block_id or transaction["blockId"]
+                sent_nfts = [
+                    (item["recipientAddress"], item["assets"]["nftId"])
+                    for item in outputs
+                ]
+                amount_recorded = write_to_csv(sent_nfts, block_id)
+
+        except Exception as e:
             logger.info(traceback.format_exc())
-        return
+            if is_transaction_too_large_error(e):
+                return False
+        return amount_recorded
 
     except ValueError as e:  # Catch the raised ValueError
         logger.info("Stopping the program: %s", e)  # Add a log message
@@ -166,16 +248,15 @@ def send_nfts(outputs):
 
     except Exception:
         logger.info(traceback.format_exc())
+    return 0
 
-def write_to_csv(shimmer_receiver_address, nftId, block_id):
+def write_to_csv(sent_nfts, block_id):
+    global sent_addresses_mtime
     try:
-        """Writes the transaction details to a CSV file."""
-        # assuming you have the following variables available:
-        # - address
-        # - token_amount
-        # - date_time
-        # - block_id
+        """Writes the transaction details of (address, nftId) pairs to a CSV file.
 
+        Returns the amount of rows written, 0 if writing failed.
+        """
         # construct the explorer link
         explorer_link = f"https://explorer.shimmer.network/shimmer/block/{block_id}"
         # Get the current date and time
@@ -184,36 +265,44 @@ def write_to_csv(shimmer_receiver_address, nftId, block_id):
         # create a list with the data to write to the CSV file
         data = [
             [shimmer_receiver_address, nftId, explorer_link, date_time]
+            for shimmer_receiver_address, nftId in sent_nfts
         ]
 
-        # open the CSV file in 'append' mode
+        # open the CSV file once in 'append' mode for the whole transaction
         with open(shimmer_address_sent_to_filename, "a", newline="") as csvfile:
             writer = csv.writer(csvfile)
             # write the data to the CSV file
             writer.writerows(data)
             logger.info(
-                f"Transaction details appended to CSV file for address: {shimmer_receiver_address}"
+                "Transaction details appended to CSV file for %s addresses", len(data)
             )
+        # Keep the cached addresses in sync without re-reading the file
+        if sent_addresses_cache is not None:
+            sent_addresses_cache.update(row[0] for row in data)
+            sent_addresses_mtime = os.stat(shimmer_address_sent_to_filename).st_mtime_ns
+        return len(data)
     except Exception:
         logger.warning(traceback.format_exc())
+        return 0
 
-def call_zealy_api(subdomain, x_api_key, api_endpoint, http_method, data=None):
+def send_zealy_request(subdomain, x_api_key, api_endpoint, http_method, data=None, headers=None):
+    """Sends a request to the Zealy API and returns the response."""
     try:
         api_url = f"https://api.zealy.io/communities/{subdomain}/{api_endpoint}"
-        headers = {"x-api-key": x_api_key}
+        headers = {**(headers or {}), "x-api-key": x_api_key}
 
         while True:
             try:
                 if http_method == "GET":
-                    response = requests.get(api_url, headers=headers)
+                    response = zealy_session.get(api_url, headers=headers)
                 elif http_method == "POST":
                     headers["Content-Type"] = "application/json"
-                    response = requests.post(api_url, headers=headers, json=data)
+                    response = zealy_session.post(api_url, headers=headers, data=orjson.dumps(data))
                 else:
                     raise ValueError("Invalid HTTP method")
 
                 response.raise_for_status()
-                return response.json()
+                return response
             except requests.exceptions.RequestException as e:
                 print(f"RequestException: {e}")
                 print("Retrying in 5 minutes...")
@@ -221,84 +310,156 @@ def call_zealy_api(subdomain, x_api_key, api_endpoint, http_method, data=None):
     except Exception:
         logger.warning(traceback.format_exc())
 
-def get_zealy_api_data(subdomain, x_api_key, quest_id, status):
-    api_endpoint = f"claimed-quests?quest_id={quest_id}&status={status}"
-    return call_zealy_api(subdomain, x_api_key, api_endpoint, "GET")
-
-def validate_zealy_api_data(subdomain, x_api_key, claimedQuestIds, status, comment):
-    api_endpoint = "claimed-quests/review"
-    data = {
-        "status": status,
-        "claimedQuestIds": claimedQuestIds,
-        "comment": comment
-    }
-    return call_zealy_api(subdomain, x_api_key, api_endpoint, "POST", data)
-
-def unique_addresses(addresses):
+def call_zealy_api(subdomain, x_api_key, api_endpoint, http_method, data=None):
     try:
-        unique_addresses = []
-        for address in addresses:
-            if address not in unique_addresses:
-                unique_addresses.append(address)
-            else:
-                logger.info(f"Skipping duplicate address: {address}")
-        logger.debug(f"unique_addresses {unique_addresses}")
-        return unique_addresses
+        response = send_zealy_request(subdomain, x_api_key, api_endpoint, http_method, data)
+        if response is None:
+            return None
+        return orjson.loads(response.content)
     except Exception:
-        logger.info(traceback.format_exc())
+        logger.warning(traceback.format_exc())
 
-def return_valid_shimmer_addresses(smr_addresses):
+def get_zealy_page(subdomain, x_api_key, quest_id, status, page, page_size):
+    """Returns one page of claimed quests, served from the cache while it is fresh."""
+    cache_key = (quest_id, status, page, page_size)
+    with zealy_cache_lock:
+        cached = zealy_cache.get(cache_key)
+    if cached and time.monotonic() - cached["fetched_at"] < zealy_cache_ttl:
+        return cached["items"]
+
+    headers = {}
+    if cached and cached["etag"]:
+        headers["If-None-Match"] = cached["etag"]
+    elif cached and cached["last_modified"]:
+        headers["If-Modified-Since"] = cached["last_modified"]
+
+    api_endpoint = (
+        f"claimed-quests?quest_id={quest_id}&status={status}"
+        f"&page={page}&limit={page_size}"
+    )
+    response = send_zealy_request(subdomain, x_api_key, api_endpoint, "GET", headers=headers)
+    if response is None:
+        return None
+    etag = response.headers.get("ETag")
+    last_modified = response.headers.get("Last-Modified")
     try:
-        shimmer_client = IotaClient()
-        valid_addresses = []
-        for i in smr_addresses:
-            if not shimmer_client.is_address_valid(i):
-                logger.debug(f"Skipping invalid address: {i}")
-            else:
-                logger.debug(f"Valid address: {i}")
-                valid_addresses.append(i)
-        logger.info(f"All valid addresses: {valid_addresses}")
-        return valid_addresses
+        if response.status_code == 304 and cached:
+            items = cached["items"]
+            # A 304 may omit the validators, keep the cached ones then
+            etag = etag or cached["etag"]
+            last_modified = last_modified or cached["last_modified"]
+        else:
+            items = orjson.loads(response.content)["data"]
     except Exception:
         logger.warning(traceback.format_exc())
+        return None
+
+    with zealy_cache_lock:
+        # Re-insert so the dict stays ordered from least to most recently fetched
+        zealy_cache.pop(cache_key, None)
+        zealy_cache[cache_key] = {
+            "fetched_at": time.monotonic(),
+            "etag": etag,
+            "last_modified": last_modified,
+            "items": items,
+        }
+        while len(zealy_cache) > zealy_cache_maxsize:
+            del zealy_cache[next(iter(zealy_cache))]
+    return items
+
+def invalidate_zealy_api_data(quest_id, status):
+    """Drops the cached pages for a quest and status."""
+    with zealy_cache_lock:
+        for cache_key in [key for key in zealy_cache if key[:2] == (quest_id, status)]:
+            del zealy_cache[cache_key]
+
+def iter_zealy_api_data(subdomain, x_api_key, quest_id, status, page_size=100):
+    """Yields the claimed quests for a quest and status, one page at a time."""
+    seen_ids = set()
+    page = 1
+    while True:
+        items = get_zealy_page(subdomain, x_api_key, quest_id, status, page, page_size)
+        if items is None:
+            if page > 1:
+                logger.warning(
+                    "Failed to get page %s of quest %s with status %s, results are partial",
+                    page, quest_id, status
+                )
+            return
+        new_items = [item for item in items if item['id'] not in seen_ids]
+        # Stop on an empty page, or when the API ignored the page and repeated items
+        if not new_items:
+            return
+        seen_ids.update(item['id'] for item in new_items)
+        yield from new_items
+        page += 1
+
+def validate_zealy_api_data(subdomain, x_api_key, claimedQuestIds, status, comment, chunk_size=50):
+    """Reviews the claimed quests, posting chunks of ids in parallel."""
+    api_endpoint = "claimed-quests/review"
+    chunks = [claimedQuestIds[i:i+chunk_size] for i in range(0, len(claimedQuestIds), chunk_size)]
+
+    def review_chunk(chunk):
+        data = {
+            "status": status,
+            "claimedQuestIds": chunk,
+            "comment": comment
+        }
+        return call_zealy_api(subdomain, x_api_key, api_endpoint, "POST", data)
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        return list(executor.map(review_chunk, chunks))
+
+@functools.lru_cache(maxsize=50_000)
+def is_shimmer_address_valid(smr_address):
+    """Checks if the address has the configured hrp and is a valid address, caching the result."""
+    if not smr_address.startswith(shimmer_address_hrp):
+        return False
+    return client.is_address_valid(smr_address)
+
+def iter_valid_shimmer_addresses(smr_addresses):
+    for i in smr_addresses:
+        try:
+            is_valid = is_shimmer_address_valid(i)
+        except Exception:
+            logger.warning(traceback.format_exc())
+            is_valid = False
+        if not is_valid:
+            logger.debug("Skipping invalid address: %s", i)
+        else:
+            logger.debug("Valid address: %s", i)
+            yield i
 
 def validate_shimmer_address(smr_address):
-    shimmer_client = IotaClient()
-    if smr_address.startswith(shimmer_address_hrp):
-        if shimmer_client.is_address_valid(smr_address):
-            return True
+    if is_shimmer_address_valid(smr_address):
+        return True
     logger.debug(smr_address)
     return False
 
 def mint_nfts(amount):
     try:
-        wallet = IotaWallet(wallet_db_name, client_options, coin_type, secret_manager)
-        account = wallet.get_account(shimmer_account_name)
+        account = get_account()
         account.sync()
         address = account.addresses()
         balance = account.get_balance()
         available_balance = int(balance['baseCoin']['total'])
-        logger.debug(f"Balance: {balance}")
-        logger.debug(f"Available balance: {available_balance}")
+        logger.debug("Balance: %s", balance)
+        logger.debug("Available balance: %s", available_balance)
         if available_balance < 10000000:
-            logger.warning(f"⚠️⚠️⚠️ Not enough balance to mint! \n⚠️⚠️⚠️ Send at least 10 000 000 glow to {address[0]['address']} before launching this program again!")
+            logger.warning("⚠️⚠️⚠️ Not enough balance to mint! \n⚠️⚠️⚠️ Send at least 10 000 000 glow to %s before launching this program again!", address[0]['address'])
             time.sleep(15)
             return
         else:
             logger.debug("Enough balance, we can mint!")
             nft_collection_size = amount
-            # Create the metadata with another index for each
-            nft_options = []
-            logger.debug(f"Collection NFT address {collection_nft_address}")
-            for index in range(nft_collection_size):
-                nft_number = index + 1
-                attribue_value = random.randint(42, 69)
-                immutable_metadata = bytes(json.dumps({
+            # Serialize the metadata once per possible rarity value
+            combined_metadatas = [
+                "0x" + json.dumps({
                     "standard": "IRC27",
                     "version": "v1.0",
                     "type": "image/png",
                     "uri": "ipfs://bafybeicnznoiprv5udy36wlrhqffa7evyoodeweh343dnjvgt3aqn4gwbm",
-                    "name": f"Mudskipper",
+                    "name": "Mudskipper",
                     "description": "The Mudskipper",
                     "issuerName": "The Queen",
                     "collectionName": "The 30y old virgin collection",
@@ -308,20 +469,26 @@ def mint_nfts(amount):
                         "value": f"{attribue_value}"
                         }
                     ]
-                }).encode('utf-8')).hex()
-
-                combined_metadata = "0x" + immutable_metadata
-
-                nft_options.append({
-                "immutableMetadata": combined_metadata,
+                }, separators=(",", ":")).encode('utf-8').hex()
+                for attribue_value in range(42, 70)
+            ]
+            logger.debug("Collection NFT address %s", collection_nft_address)
+            # Pick a random rarity for each NFT
+            nft_options = [
+                {
+                "immutableMetadata": random.choice(combined_metadatas),
                 "issuer": collection_nft_address,
-                })
-            logger.debug(f"NFT Options: {nft_options}")
+                }
+                for _ in range(nft_collection_size)
+            ]
+            logger.debug("NFT Options: %s", nft_options)
             
+            # Each batch spends the collection NFT and remainder of the previous one,
+            # so it has to be included and synced before the next batch is minted
             for nft in [nft_options[i:i+50] for i in range(0, len(nft_options), 50)]:
                 transaction = account.mint_nfts(nft)
                 transaction_id = transaction['transactionId']
-                logger.debug(f"Minted NFT with options: {nft}")
+                logger.debug("Minted NFT with options: %s", nft)
                 logger.debug("NFT pending transaction id: %s", transaction_id)
                 account.retry_transaction_until_included(transaction_id)
                 account.sync()
@@ -338,17 +505,14 @@ def mint_nfts(amount):
 def get_available_nfts():
     logger.debug("Checking for available NFTs")
     # Sync account with the node
-    wallet = IotaWallet(wallet_db_name, client_options, coin_type, secret_manager)
-    account = wallet.get_account(shimmer_account_name)
+    account = get_account()
     response = account.sync()
-    logger.debug(f'Synced response in get available: {response}')
+    logger.debug("Synced response in get available: %s", response)
     nfts = response['nfts']
-    print(nfts)
-    print(len(nfts))
-    logger.info(f"Available NFTs in get function: {len(nfts)}")
+    logger.info("Available NFTs in get function: %s", len(nfts))
     if len(nfts) == 0:
         logger.info(
-            f"⚠️There are no NFTs available {nfts}\n⚠️Make sure to have the Collection NFT in this address and to add the Collection NFT ID to the .env file before you continue."
+            "⚠️There are no NFTs available\n⚠️Make sure to have the Collection NFT in this address and to add the Collection NFT ID to the .env file before you continue."
             )
         sys.exit(1)
     else:
@@ -367,9 +531,7 @@ def create_shimmer_profile():
         print("Creating new profile")
         # This creates a new database and account
         try:
-            wallet = IotaWallet(
-                wallet_db_name, client_options, coin_type, secret_manager
-            )
+            wallet = get_wallet()
             account = wallet.store_mnemonic(shimmer_mnemonic)
             account = wallet.create_account(shimmer_account_name)
 